@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the hot paths of audio_test.
+
+Run with the name of a benchmark (or nothing, to run all of them):
+
+    ./benchmark.py spectrum_analyzer
+"""
+from __future__ import division, print_function
+import os
+import random
+import subprocess
+import sys
+import timeit
+
+import audiotest
+
+
+def _report(name, seconds, runs):
+    print("%-66s %10.2f us/call" % (name, seconds * 1e6 / runs))
+
+
+def benchmark_spectrum_analyzer(bands=(256, 4096, 65536), samples=20):
+    """Compare list and array-backed SpectrumAnalyzers.
+
+       Times sample() for a full run of samples plus a single
+       frequencies_with_peak_magnitude() call, as main() would.
+    """
+    classes = [audiotest.SpectrumAnalyzer]
+    if audiotest.numpy is not None:
+        classes.append(audiotest.NumpySpectrumAnalyzer)
+    else:
+        print("numpy not available, only benchmarking SpectrumAnalyzer")
+    for points in bands:
+        spectrums = [[random.uniform(-60, 0) for i in range(points)]
+                     for s in range(samples)]
+        for analyzer_class in classes:
+            analyzer = analyzer_class(points=points)
+
+            def run_sample():
+                analyzer.sample(spectrums[analyzer.number_of_samples %
+                                          samples])
+
+            runs = max(10, 200000 // points)
+            _report("%s.sample (%d bands)" % (analyzer_class.__name__,
+                                              points),
+                    timeit.timeit(run_sample, number=runs), runs)
+            runs = max(3, runs // 10)
+            _report("%s.frequencies_with_peak_magnitude (%d bands)" %
+                    (analyzer_class.__name__, points),
+                    timeit.timeit(analyzer.frequencies_with_peak_magnitude,
+                                  number=runs), runs)
+
+
+def spectrum_message(bands):
+    """Builds the string form of a spectrum message with given bands."""
+    magnitudes = ", ".join("%.15g" % random.uniform(-60, 0)
+                           for i in range(bands))
+    return ("spectrum, endtime=(guint64)4700000000, "
+            "timestamp=(guint64)4600000000, stream-time=(guint64)4600000000, "
+            "running-time=(guint64)4600000000, duration=(guint64)100000000, "
+            "magnitude=(float){ %s };" % magnitudes)
+
+
+def benchmark_structure_extraction(bands=(256, 4096), runs=200):
+    """Compare reading magnitudes directly from a Gst.Structure against
+       serializing and parsing it.
+    """
+    #init_gstreamer exits without GStreamer, which would stop the other
+    #benchmarks too
+    try:
+        import gi
+        gi.require_version('Gst', '1.0')
+    except (ImportError, ValueError) as excp:
+        print("GStreamer not available, skipping structure extraction: %s" %
+              excp)
+        return
+    audiotest.init_gstreamer()
+    for points in bands:
+        structure = audiotest.Gst.Structure.from_string(
+            spectrum_message(points))
+        #Some versions return (structure, end)
+        if isinstance(structure, tuple):
+            structure = structure[0]
+        try:
+            audiotest.magnitudes_from_structure(structure)
+        except (TypeError, ValueError, AttributeError) as excp:
+            print("Direct extraction unavailable: %s" % excp)
+        else:
+            _report("magnitudes_from_structure (%d bands)" % points,
+                    timeit.timeit(lambda: audiotest.magnitudes_from_structure(
+                                  structure), number=runs), runs)
+        _report("to_string + parse_spectrum_message_structure (%d bands)" %
+                points,
+                timeit.timeit(lambda: audiotest.parse_spectrum_message_structure(
+                              structure.to_string()), number=runs), runs)
+
+
+def benchmark_structure_parsing(bands=(256, 8192), runs=100):
+    """Parse time per message for the JSON-based parser and the scanner."""
+    for points in bands:
+        message = spectrum_message(points)
+        parsers = [
+            ("parse_spectrum_message_structure",
+             lambda: audiotest.parse_spectrum_message_structure(
+                 message)['magnitude']),
+            ("scan_spectrum_message_structure",
+             lambda: audiotest.scan_spectrum_message_structure(
+                 message)['magnitude']),
+            ("scan_spectrum_message_structure, array('f')",
+             lambda: audiotest.scan_spectrum_message_structure(
+                 message, typecode='f')['magnitude'])]
+        for name, parser in parsers:
+            _report("%s (%d bands)" % (name, points),
+                    timeit.timeit(parser, number=runs), runs)
+
+
+def benchmark_pid_convergence(messages=300):
+    """Settle time and overshoot of the recording volume control loop,
+       with the default gains, on simulated recording paths.
+    """
+    #Some paths can't be held within 1 dB: the noisy one because of the
+    #noise, the loud one because 1% of volume is about 2 dB there
+    plants = [("default", {}, 1.0),
+              ("3 messages of latency", {'latency': 3}, 1.0),
+              ("noisy (2 dB)", {'noise': 2.0}, 2.0),
+              ("quiet (-2 dB at 100%)", {'level_at_full': -2.0}, 1.0),
+              ("loud (+20 dB at 100%)", {'level_at_full': 20.0}, 3.0)]
+    for name, model, tolerance in plants:
+        pid = audiotest.PIDController(setpoint=audiotest.REC_LEVEL_SETPOINT,
+                                      **audiotest.PID_GAINS)
+        pid.set_change_limit(audiotest.PID_CHANGE_LIMIT)
+        started = timeit.default_timer()
+        result = audiotest.simulate_level_control(
+            audiotest.LevelPlant(**model), pid, messages=messages,
+            tolerance=tolerance)
+        elapsed = timeit.default_timer() - started
+        settle_time = result['settle_time']
+        #Level messages that would let a spectrum be sampled, after 5 s
+        in_range = result['in_range'][50:]
+        print("%-24s settles within %.1f dB %-8s overshoot %5.2f dB, "
+              "%3.0f%% in range" %
+              (name, tolerance, "never" if settle_time is None else
+                     "%.1f s" % settle_time, result['overshoot'],
+               100.0 * in_range.count(True) / max(len(in_range), 1)))
+        _report("simulate_level_control (%s)" % name, elapsed, messages)
+
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import audiotest
+print(time.perf_counter() - start, flush=True)
+start = time.perf_counter()
+audiotest.init_gstreamer()
+print(time.perf_counter() - start, flush=True)
+start = time.perf_counter()
+audiotest.Player()
+print(time.perf_counter() - start, flush=True)
+"""
+
+
+def benchmark_startup(runs=5):
+    """Time from importing audiotest to having its first pipeline.
+
+       Each run is a new interpreter, so nothing is already imported or
+       initialized.
+    """
+    steps = ["import audiotest", "init_gstreamer", "first pipeline (Player)"]
+    totals = [0.0] * len(steps)
+    completed = len(steps)
+    for run in range(runs):
+        process = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT],
+                                   cwd=os.path.dirname(
+                                       os.path.abspath(__file__)),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL,
+                                   universal_newlines=True)
+        times = [float(line) for line in process.communicate()[0].split()]
+        completed = min(completed, len(times))
+        for step, seconds in enumerate(times):
+            totals[step] += seconds
+    for step in range(completed):
+        _report(steps[step], totals[step], runs)
+    if completed:
+        _report("import to first pipeline", sum(totals[:completed]), runs)
+    if completed < len(steps):
+        print("GStreamer not available, stopped after %s" %
+              (steps[completed - 1] if completed else "starting"))
+
+
+BENCHMARKS = {'pid_convergence': benchmark_pid_convergence,
+              'spectrum_analyzer': benchmark_spectrum_analyzer,
+              'startup': benchmark_startup,
+              'structure_extraction': benchmark_structure_extraction,
+              'structure_parsing': benchmark_structure_parsing}
+
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark %s, choose from: %s" %
+                  (name, ", ".join(sorted(BENCHMARKS))), file=sys.stderr)
+            return 1
+        print("== %s" % name)
+        BENCHMARKS[name]()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,15 @@
 #!/usr/bin/env python3
 from __future__ import print_function
+import math
+import os
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import threading
 import unittest
+import wave
 import audiotest 
 
 class TestPIDController(unittest.TestCase):
@@ -38,27 +47,147 @@ class TestPIDController(unittest.TestCase):
         self.assertTrue(abs(input_change) <= limit)
         self.assertTrue(input_change / abs(input_change) == -1)
 
-class TestVolumeControl(unittest.TestCase):
+    def test_reset(self):
+        pid = audiotest.PIDController(Kp=0.3, Ki=0.5,Kd=0.7, setpoint=5)
+        first_change = pid.input_change(0, dt=0.1)
+        pid.input_change(2, dt=0.1)
+        pid.reset()
+        self.assertEqual(pid._integral, 0)
+        self.assertEqual(first_change, pid.input_change(0, dt=0.1))
 
-    def setUp(self):
-        self.pactl_output = "0\talsa_output.pci-0001_00_1b.0.analog-stereo\t" + \
-                            "module-alsa-card.c\ts16le 2ch 44100Hz\tSUSPENDED" + \
-                            "\n" +\
+    def test_timestamps(self):
+        pid = audiotest.PIDController(Kp=0.3, Ki=0.5,Kd=0.7, setpoint=5)
+        reference = audiotest.PIDController(Kp=0.3, Ki=0.5,Kd=0.7, setpoint=5)
+        #First feedback uses the nominal interval
+        self.assertEqual(reference.input_change(0, dt=0.1),
+                         pid.input_change_at(0, timestamp=12.0))
+        self.assertEqual(reference.input_change(1, dt=0.25),
+                         pid.input_change_at(1, timestamp=12.25))
+
+    def test_timestamp_gaps_clamped(self):
+        pid = audiotest.PIDController(Kp=0.3, Ki=0.5,Kd=0.7, setpoint=5)
+        reference = audiotest.PIDController(Kp=0.3, Ki=0.5,Kd=0.7, setpoint=5)
+        pid.set_dt_limits(0.01, 0.5)
+        pid.input_change_at(0, timestamp=1.0)
+        reference.input_change(0, dt=0.1)
+        #A long gap
+        self.assertEqual(reference.input_change(1, dt=0.5),
+                         pid.input_change_at(1, timestamp=30.0))
+        #Same timestamp again
+        self.assertEqual(reference.input_change(2, dt=0.01),
+                         pid.input_change_at(2, timestamp=30.0))
+        pid.reset()
+        reference.reset()
+        self.assertEqual(reference.input_change(0, dt=0.1),
+                         pid.input_change_at(0, timestamp=0.0))
+
+class TestPIDSimulation(unittest.TestCase):
+    def pid(self):
+        pid = audiotest.PIDController(setpoint=audiotest.REC_LEVEL_SETPOINT,
+                                      **audiotest.PID_GAINS)
+        pid.set_change_limit(audiotest.PID_CHANGE_LIMIT)
+        return pid
+
+    def test_plant(self):
+        plant = audiotest.LevelPlant(level_at_full=6.0, noise=0)
+        self.assertEqual(-60, plant.level(0))
+        self.assertAlmostEqual(0.0, plant.level(50.11872336), places=5)
+        self.assertEqual(0.0, plant.level(100))
+        self.assertAlmostEqual(-14.0, plant.level(10))
+        self.assertEqual(plant.level(10), plant.measure(10))
+
+    def test_volume_latency(self):
+        controller = audiotest.SimulatedVolumeController(0, latency=2)
+        controller.set_volume(30)
+        self.assertEqual(30, controller.get_volume())
+        for i in range(2):
+            controller.advance()
+            self.assertEqual(0, controller.applied_volume)
+        controller.advance()
+        self.assertEqual(30, controller.applied_volume)
+        self.assertFalse(controller.set_volume(101))
+
+    def test_default_gains_converge(self):
+        result = audiotest.simulate_level_control(audiotest.LevelPlant(),
+                                                  self.pid())
+        self.assertLessEqual(result['settle_time'], 2.0)
+        self.assertLess(result['overshoot'], 1.0)
+
+    def test_converge_with_latency(self):
+        result = audiotest.simulate_level_control(
+            audiotest.LevelPlant(latency=3), self.pid())
+        self.assertLessEqual(result['settle_time'], 3.0)
+        self.assertLess(result['overshoot'], 2.0)
+
+    def test_whole_percent_volumes(self):
+        controller = audiotest.SimulatedVolumeController(0, latency=1)
+        controller.set_volume(30.7)
+        controller.advance()
+        controller.advance()
+        self.assertEqual(30, controller.applied_volume)
+        self.assertEqual(30.7, controller.get_volume())
+
+    def test_loud_path(self):
+        #At +20 dB the setpoint is at 4.5%, where a 1% step is about 2 dB,
+        #so the loop keeps hunting between the volumes around it, but
+        #they're all well within the range
+        for seed in range(5):
+            plant = audiotest.LevelPlant(level_at_full=20.0, seed=seed)
+            result = audiotest.simulate_level_control(plant, self.pid())
+            for level in result['levels'][20:]:
+                self.assertLessEqual(audiotest.REC_LEVEL_RANGE[1], level)
+                self.assertLessEqual(level, audiotest.REC_LEVEL_RANGE[0])
+
+    def test_noisy_path(self):
+        #The level can't be kept any closer than the measurement noise
+        for seed in range(5):
+            plant = audiotest.LevelPlant(noise=2.0, seed=seed)
+            result = audiotest.simulate_level_control(plant, self.pid(),
+                                                      tolerance=2.0)
+            self.assertLessEqual(result['settle_time'], 1.5)
+
+    def test_converged_loop_keeps_sampling(self):
+        for model in ({}, {'latency': 3}, {'noise': 2.0},
+                      {'level_at_full': 20.0}):
+            for seed in range(5):
+                plant = audiotest.LevelPlant(seed=seed, **model)
+                result = audiotest.simulate_level_control(plant, self.pid())
+                #Once converged, hardly any spectrum is thrown away
+                converged = result['in_range'][50:]
+                self.assertGreaterEqual(converged.count(True),
+                                        0.9 * len(converged), model)
+
+    def test_unreachable_setpoint(self):
+        #Even at 100% the level doesn't get to the setpoint
+        plant = audiotest.LevelPlant(level_at_full=-8.0, noise=0)
+        result = audiotest.simulate_level_control(plant, self.pid())
+        self.assertIsNone(result['settle_time'])
+        self.assertAlmostEqual(-8.0, result['levels'][-1], places=0)
+
+
+class PactlFixtures(object):
+    """pactl listings shared by the volume controller tests."""
+    pactl_output = "0\talsa_output.pci-0001_00_1b.0.analog-stereo\t" + \
+                   "module-alsa-card.c\ts16le 2ch 44100Hz\tSUSPENDED" + \
+                   "\n" +\
 "5\talsa_output.usb-0d8c_C-Media_USB_Headphone_Set-00-Set.analog-stereo\tmodule-alsa-card.c\ts16le 2ch 44100Hz\tSUSPENDED"
 
-        self.pactl_input = "0\talsa_output.pci-0001_00_1b.0.analog-stereo.monitor\t" +\
-                           "module-alsa-card.c\ts16le 2ch 44100Hz\tIDLE\n" +\
-                           "1\talsa_input.pci-0001_00_1b.0.analog-stereo\t" +\
-                           "module-alsa-card.c\ts16le 2ch 44100Hz\tSUSPENDED"  + \
-                           "\n" + \
+    pactl_input = "0\talsa_output.pci-0001_00_1b.0.analog-stereo.monitor\t" +\
+                  "module-alsa-card.c\ts16le 2ch 44100Hz\tIDLE\n" +\
+                  "1\talsa_input.pci-0001_00_1b.0.analog-stereo\t" +\
+                  "module-alsa-card.c\ts16le 2ch 44100Hz\tSUSPENDED"  + \
+                  "\n" + \
 "10\talsa_output.usb-0d8c_C-Media_USB_Headphone_Set-00-Set.analog-stereo.monitor\tmodule-alsa-card.c\ts16le 2ch 44100Hz\tSUSPENDED" + \
-                           "\n" + \
+                  "\n" + \
 "11\talsa_input.usb-0d8c_C-Media_USB_Headphone_Set-00-Set.analog-mono\tmodule-alsa-card.c\ts16le 1ch 44100Hz\tRUNNING"
 
-        self.pactl_null_output = "0\tauto_null\tmodule-null-sink.c\t" +\
-                                 "s16le 2ch 44100Hz\tIDLE"
-        self.pactl_null_input = "0\tauto_null.monitor\t" +\
-                                "module-null-sink.c\ts16le 2ch 44100Hz\tIDLE"
+    pactl_null_output = "0\tauto_null\tmodule-null-sink.c\t" +\
+                        "s16le 2ch 44100Hz\tIDLE"
+    pactl_null_input = "0\tauto_null.monitor\t" +\
+                       "module-null-sink.c\ts16le 2ch 44100Hz\tIDLE"
+
+
+class TestVolumeControl(PactlFixtures, unittest.TestCase):
 
     def test_invalid_type(self):
         vc = audiotest.PAVolumeController('invalid_type', method=lambda x: 
@@ -150,6 +279,604 @@ class TestVolumeControl(unittest.TestCase):
         self.assertFalse(vc.get_identifier())
 
 
+class TestPacmdSession(PactlFixtures, unittest.TestCase):
+    def setUp(self):
+        fd, self.log = tempfile.mkstemp()
+        os.close(fd)
+        #Stands in for pacmd, records every command it gets and fails
+        #the ones for device 99
+        self.stub = [sys.executable, '-c',
+                     'import sys\n'
+                     'with open(sys.argv[1], "w") as f:\n'
+                     '    for line in sys.stdin:\n'
+                     '        command = line.split()\n'
+                     '        if not command[0].startswith("set-"):\n'
+                     '            print("Unknown command: " + command[0])\n'
+                     '        elif command[1] == "99":\n'
+                     '            print("No sink found by this index.")\n'
+                     '        else:\n'
+                     '            f.write(line)\n'
+                     '            f.flush()\n'
+                     '        sys.stdout.flush()\n',
+                     self.log]
+
+    def tearDown(self):
+        os.unlink(self.log)
+
+    def commands_received(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_volume_and_mute_use_one_process(self):
+        session = audiotest.PacmdSession(command=self.stub)
+        pactl_calls = []
+
+        def pactl(command):
+            pactl_calls.append(command)
+            return self.pactl_input
+
+        vc = audiotest.PAVolumeController('input', method=session)
+        vc._pactl_output = pactl
+        self.assertTrue(vc.get_identifier())
+        self.assertTrue(vc.set_volume(100))
+        process = session._process
+        self.assertTrue(vc.set_volume(50))
+        self.assertTrue(vc.mute(False))
+        self.assertIs(process, session._process)
+        session.close()
+        self.assertEqual(['set-source-volume 1 65536',
+                          'set-source-volume 1 32768',
+                          'set-source-mute 1 0'],
+                         self.commands_received())
+        #Only the listing went through pactl
+        self.assertEqual([['pactl', 'list', 'sources', 'short']], pactl_calls)
+
+    def test_unknown_command_not_implemented(self):
+        session = audiotest.PacmdSession(command=self.stub)
+        self.assertIs(NotImplemented,
+                      session(['pactl', 'list', 'sinks', 'short']))
+        self.assertIsNone(session._process)
+
+    def test_dead_process_is_restarted(self):
+        session = audiotest.PacmdSession(command=self.stub)
+        self.assertEqual('', session(['pactl', 'set-sink-mute', '0', '1']))
+        session._process.stdin.close()
+        session._process.wait()
+        self.assertEqual('', session(['pactl', 'set-sink-mute', '0', '0']))
+        session.close()
+        self.assertEqual(['set-sink-mute 0 0'], self.commands_received())
+
+    def test_missing_program(self):
+        session = audiotest.PacmdSession(command=['/nonexistent/pacmd'])
+        self.assertFalse(session(['pactl', 'set-sink-mute', '0', '1']))
+
+    def test_error_reply(self):
+        session = audiotest.PacmdSession(command=self.stub)
+        self.assertFalse(session(['pactl', 'set-sink-mute', '99', '1']))
+        #The session is still usable
+        self.assertEqual('', session(['pactl', 'set-sink-mute', '0', '1']))
+        session.close()
+        self.assertEqual(['set-sink-mute 0 1'], self.commands_received())
+
+    def test_process_exits_at_once(self):
+        session = audiotest.PacmdSession(command=[sys.executable, '-c', ''])
+        self.assertFalse(session(['pactl', 'set-sink-mute', '0', '1']))
+        self.assertIsNone(session._process)
+
+    def test_no_reply(self):
+        #Reads its input but never answers
+        stub = [sys.executable, '-c',
+                'import sys, time\n'
+                'sys.stdin.readline()\n'
+                'time.sleep(30)\n']
+        session = audiotest.PacmdSession(command=stub, timeout=0.2)
+        self.assertFalse(session(['pactl', 'set-sink-mute', '0', '1']))
+        self.assertIsNone(session._process)
+
+
+class TestDeviceCache(PactlFixtures, unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.filename)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+    def controller(self, pactl_output):
+        return audiotest.PAVolumeController(
+            'input', method=lambda x: pactl_output,
+            device_cache=audiotest.DeviceCache(self.filename))
+
+    def test_valid_elements(self):
+        vc = audiotest.PAVolumeController('input',
+                                          method=lambda x: self.pactl_input)
+        self.assertEqual([(1, 'alsa_input.pci-0001_00_1b.0.analog-stereo',
+                           's16le 2ch 44100Hz'),
+                          (11, 'alsa_input.usb-0d8c_C-Media_USB_Headphone_'
+                               'Set-00-Set.analog-mono', 's16le 1ch 44100Hz')],
+                         vc._valid_elements('input'))
+
+    def test_cold_and_warm_run(self):
+        vc = self.controller(self.pactl_input)
+        self.assertEqual(1, vc.get_identifier()[0])
+        self.assertIsNone(vc.device_cache.volume('input'))
+        vc.device_cache.set_volume('input', 35)
+        self.assertTrue(vc.device_cache.save())
+
+        vc = self.controller(self.pactl_input)
+        self.assertEqual(35, vc.device_cache.volume('input'))
+        self.assertEqual(1, vc.get_identifier()[0])
+
+    def test_cached_device_preferred_and_renumbered(self):
+        cache = audiotest.DeviceCache(self.filename)
+        cache.set_device('input', (11, 'alsa_input.usb-0d8c_C-Media_USB_'
+                                   'Headphone_Set-00-Set.analog-mono',
+                                   's16le 1ch 44100Hz'))
+        cache.set_volume('input', 60)
+        cache.save()
+        #Same device, different PulseAudio id
+        vc = self.controller(self.pactl_input.replace("11\t", "12\t"))
+        self.assertEqual(12, vc.get_identifier()[0])
+        self.assertEqual(60, vc.device_cache.volume('input'))
+
+    def test_changed_device_forgets_volume(self):
+        cache = audiotest.DeviceCache(self.filename)
+        cache.set_device('input', (1, 'alsa_input.pci-0001_00_1b.0.analog-'
+                                   'stereo', 's16le 2ch 48000Hz'))
+        cache.set_volume('input', 60)
+        cache.save()
+        vc = self.controller(self.pactl_input)
+        self.assertEqual(1, vc.get_identifier()[0])
+        self.assertIsNone(vc.device_cache.volume('input'))
+
+    def test_corrupt_cache(self):
+        with open(self.filename, "w") as f:
+            f.write("{not json")
+        vc = self.controller(self.pactl_input)
+        self.assertEqual(1, vc.get_identifier()[0])
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_exponential_backoff_until_deadline(self):
+        clock = FakeClock()
+        policy = audiotest.RetryPolicy(initial_delay=100, jitter=0,
+                                       deadline=2, clock=clock,
+                                       sleep=clock.sleep)
+        for delay in policy.delays():
+            policy.sleep(delay)
+        self.assertEqual([0.1, 0.2, 0.4, 0.8, 0.5],
+                         [round(d, 6) for d in clock.sleeps])
+
+    def test_jitter_and_max_delay(self):
+        clock = FakeClock()
+        policy = audiotest.RetryPolicy(initial_delay=1000, max_delay=1000,
+                                       jitter=0.5, deadline=60, clock=clock)
+        delays = policy.delays()
+        for i in range(10):
+            self.assertTrue(0.5 <= next(delays) <= 1.5)
+
+    def test_deadline_is_shared(self):
+        clock = FakeClock()
+        policy = audiotest.RetryPolicy(deadline=1, clock=clock)
+        next(policy.delays())
+        clock.now = 0.5
+        #A later command doesn't get a fresh deadline
+        next(policy.delays())
+        clock.now = 1.0
+        self.assertEqual([], list(policy.delays()))
+
+    def test_own_backoff_after_startup(self):
+        clock = FakeClock()
+        policy = audiotest.RetryPolicy(initial_delay=100, jitter=0,
+                                       deadline=1, retries=3, clock=clock,
+                                       sleep=clock.sleep)
+        for delay in policy.delays():
+            policy.sleep(delay)
+        clock.now = 30.0
+        self.assertEqual([], list(policy.delays()))
+        policy.end_startup()
+        #Long after the startup deadline, each call still retries
+        for i in range(2):
+            self.assertEqual([0.1, 0.2, 0.4],
+                             [round(d, 6) for d in policy.delays()])
+
+    def test_backoff_after_startup_bounded_by_deadline(self):
+        clock = FakeClock()
+        policy = audiotest.RetryPolicy(initial_delay=400, jitter=0,
+                                       deadline=1, retries=5, clock=clock,
+                                       sleep=clock.sleep)
+        policy.end_startup()
+        for delay in policy.delays():
+            policy.sleep(delay)
+        self.assertEqual([0.4, 0.6], [round(d, 6) for d in clock.sleeps])
+
+    def test_pactl_retries(self):
+        clock = FakeClock()
+        policy = audiotest.RetryPolicy(initial_delay=100, jitter=0,
+                                       deadline=1, clock=clock,
+                                       sleep=clock.sleep)
+        vc = audiotest.PAVolumeController('input', retry_policy=policy)
+        self.assertFalse(vc._pactl_output(["false"]))
+        self.assertEqual(1.0, round(clock.now, 6))
+        #Deadline is gone, no more waiting
+        self.assertEqual('', vc._pactl_output(["true"]))
+        self.assertFalse(vc._pactl_output(["false"]))
+        self.assertEqual(1.0, round(clock.now, 6))
+
+    def test_pactl_missing(self):
+        clock = FakeClock()
+        policy = audiotest.RetryPolicy(clock=clock, sleep=clock.sleep)
+        vc = audiotest.PAVolumeController('input', retry_policy=policy)
+        self.assertFalse(vc._pactl_output(["/nonexistent/pactl"]))
+        self.assertEqual([], clock.sleeps)
+
+
+class TestCoalescingVolumeControl(PactlFixtures, unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        self.clock = FakeClock()
+
+    def method(self, command):
+        self.commands.append(command)
+        return self.pactl_input
+
+    def volumes_sent(self):
+        return [c[3] for c in self.commands if c[1] == 'set-source-volume']
+
+    def test_same_integer_volume_is_suppressed(self):
+        vc = audiotest.CoalescingPAVolumeController('input', method=self.method)
+        vc.get_identifier()
+        for volume in (10, 10.2, 10.9, 11.1, 11, 12):
+            self.assertTrue(vc.set_volume(volume))
+        self.assertEqual(['10%', '11%', '12%'], self.volumes_sent())
+        self.assertEqual(3, vc.commands_issued)
+        self.assertEqual(3, vc.commands_suppressed)
+        self.assertEqual(12, vc.get_volume())
+
+    def test_fractional_changes_accumulate(self):
+        vc = audiotest.CoalescingPAVolumeController('input', method=self.method)
+        vc.get_identifier()
+        vc.set_volume(10)
+        for i in range(4):
+            vc.set_volume(vc.get_volume() + 0.3)
+        self.assertEqual(['10%', '11%'], self.volumes_sent())
+
+    def test_rate_limit_and_flush(self):
+        vc = audiotest.CoalescingPAVolumeController('input', max_rate=2,
+                                                    clock=self.clock,
+                                                    method=self.method)
+        vc.get_identifier()
+        vc.set_volume(10)
+        self.clock.now = 0.1
+        vc.set_volume(20)
+        self.clock.now = 0.2
+        vc.set_volume(30)
+        self.assertEqual(['10%'], self.volumes_sent())
+        self.clock.now = 0.6
+        vc.set_volume(40)
+        self.assertEqual(['10%', '40%'], self.volumes_sent())
+        self.clock.now = 0.7
+        vc.set_volume(50)
+        self.assertTrue(vc.flush())
+        self.assertEqual(['10%', '40%', '50%'], self.volumes_sent())
+        self.assertTrue(vc.flush())
+        self.assertEqual(3, len(self.volumes_sent()))
+
+    def test_invalid_volume(self):
+        vc = audiotest.CoalescingPAVolumeController('input', method=self.method)
+        self.assertFalse(vc.set_volume(10))
+        vc.get_identifier()
+        self.assertFalse(vc.set_volume(101))
+
+    def test_failed_command_is_retried(self):
+        vc = audiotest.CoalescingPAVolumeController('input', method=self.method)
+        vc.get_identifier()
+        vc.method = lambda x: False
+        self.assertFalse(vc.set_volume(10))
+        vc.method = self.method
+        self.assertTrue(vc.set_volume(10))
+        self.assertEqual(['10%'], self.volumes_sent())
+
+
+class TestCommandWorker(PactlFixtures, unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.commands = []
+
+    def blocking_method(self, command):
+        if command[1].startswith('list'):
+            return self.pactl_input
+        self.started.set()
+        self.release.wait(5)
+        self.commands.append(command)
+        return ''
+
+    def test_latest_volume_wins(self):
+        worker = audiotest.CommandWorker()
+        vc = audiotest.PAVolumeController('input', method=self.blocking_method,
+                                          worker=worker)
+        vc.get_identifier()
+        #The first command blocks the worker, the next ones pile up
+        self.assertTrue(vc.set_volume(10))
+        self.assertTrue(self.started.wait(5))
+        for volume in range(20, 60, 10):
+            self.assertTrue(vc.set_volume(volume))
+        self.assertTrue(vc.mute(False))
+        self.assertEqual(50, vc.get_volume())
+        self.release.set()
+        worker.close(5)
+        volumes = [c[3] for c in self.commands if c[1] == 'set-source-volume']
+        self.assertEqual(['10%', '50%'], volumes)
+        self.assertEqual(6, worker.submitted)
+        self.assertEqual(3, worker.dropped)
+        self.assertIn(['pactl', 'set-source-mute', '1', '0'], self.commands)
+
+    def test_close_runs_pending_commands(self):
+        self.release.set()
+        worker = audiotest.CommandWorker()
+        worker.submit('a', self.blocking_method, ['pactl', 'a'])
+        worker.submit('b', self.blocking_method, ['pactl', 'b'])
+        worker.close(5)
+        self.assertEqual([['pactl', 'a'], ['pactl', 'b']], self.commands)
+
+
+class TestMainLoopStallMonitor(unittest.TestCase):
+    def test_record(self):
+        monitor = audiotest.MainLoopStallMonitor(interval=10)
+        monitor.record(0.009)
+        monitor.record(0.110)
+        monitor.record(0.030)
+        self.assertEqual(3, monitor.ticks)
+        self.assertAlmostEqual(0.1, monitor.max_stall)
+        self.assertAlmostEqual(0.12, monitor.total_stall)
+
+
+class FakeElement(object):
+    """Element with a clock at a given time, in nanoseconds."""
+    def __init__(self, time=None, base_time=0):
+        self.time = time
+        self.base_time = base_time
+
+    def get_clock(self):
+        if self.time is None:
+            return None
+        return self
+
+    def get_time(self):
+        return self.time
+
+    def get_base_time(self):
+        return self.base_time
+
+
+class FakeMessage(object):
+    def __init__(self, src, fields):
+        self.src = src
+        self.fields = fields
+
+    def get_structure(self):
+        return self
+
+    def get_value(self, field):
+        return self.fields[field]
+
+
+class TestLatency(unittest.TestCase):
+    def test_histogram(self):
+        histogram = audiotest.LatencyHistogram()
+        for seconds in (0.0005, 0.003, 0.004, 0.3, 2.0):
+            histogram.record(seconds)
+        self.assertEqual([1, 0, 2, 0, 0, 0, 0, 0, 1, 0, 1], histogram.counts)
+        self.assertEqual(5, histogram.count)
+        self.assertAlmostEqual(2000, histogram.maximum)
+        report = histogram.report("level delay")
+        self.assertIn("5 samples", report)
+        self.assertIn("   2-   5 ms: 2", report)
+        self.assertIn("> 1000 ms: 1", report)
+        self.assertIn("no samples",
+                      audiotest.LatencyHistogram().report("spectrum delay"))
+
+    def test_bucket_bounds(self):
+        histogram = audiotest.LatencyHistogram()
+        histogram.record(0.001)
+        self.assertEqual(1, histogram.counts[0])
+
+    def test_message_delay(self):
+        element = FakeElement(time=5250000000, base_time=500000000)
+        message = FakeMessage(element, {'running-time': 4600000000,
+                                        'duration': 100000000,
+                                        'endtime': 4700000000})
+        self.assertAlmostEqual(0.05, audiotest.message_delay(message))
+        message = FakeMessage(FakeElement(), {'running-time': 4600000000,
+                                              'duration': 100000000})
+        self.assertIsNone(audiotest.message_delay(message))
+
+    def test_message_delay_after_pause(self):
+        #Stream time stood still for 2 s while running time went on
+        element = FakeElement(time=7250000000, base_time=500000000)
+        message = FakeMessage(element, {'running-time': 6600000000,
+                                        'duration': 100000000,
+                                        'endtime': 4700000000})
+        self.assertAlmostEqual(0.05, audiotest.message_delay(message))
+
+
+class TestTraceRecorder(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracer = audiotest.TraceRecorder(clock=self.clock)
+
+    def test_events(self):
+        self.clock.now = 0.001
+        self.tracer.instant("sample", 'analysis', {'samples': 1})
+        started = self.clock()
+        self.clock.now = 0.0035
+        self.tracer.complete("set-source-volume", 'pactl', started)
+        instant, complete = self.tracer.events
+        self.assertEqual('i', instant['ph'])
+        self.assertAlmostEqual(1000, instant['ts'])
+        self.assertEqual({'samples': 1}, instant['args'])
+        self.assertEqual('X', complete['ph'])
+        self.assertAlmostEqual(1000, complete['ts'])
+        self.assertAlmostEqual(2500, complete['dur'])
+        self.assertNotIn('args', complete)
+
+    def test_volume_commands(self):
+        pactl_output = "0\talsa_input.pci\tmodule-alsa-card.c\t" + \
+                       "s16le 2ch 44100Hz\tSUSPENDED"
+        vc = audiotest.PAVolumeController('input',
+                                          method=lambda x: pactl_output,
+                                          tracer=self.tracer)
+        vc.get_identifier()
+        vc.set_volume(50)
+        self.assertEqual(['list', 'set-source-volume'],
+                         [event['name'] for event in self.tracer.events])
+        self.assertEqual("pactl set-source-volume 0 50%",
+                         self.tracer.events[1]['args']['command'])
+
+    def test_sampling_decisions(self):
+        gmh = audiotest.GStreamerMessageHandler(
+            rec_level_range=(-2.0, -12.0), logger=audiotest.logging,
+            volumecontroller=None, pidcontroller=None,
+            spectrum_analyzer=None, tracer=self.tracer)
+        analyzer = audiotest.SpectrumAnalyzer(points=3)
+        gmh.discard(0.1)
+        gmh.current_level = -5.0
+        gmh.spectrum_method(analyzer, [0, 1, 0])
+        gmh.spectrum_method(analyzer, [0, 1, 0])
+        self.assertEqual(["discard", "sample"],
+                         [event['name'] for event in self.tracer.events])
+
+    def test_save(self):
+        self.tracer.instant("sample", 'analysis')
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertTrue(self.tracer.save(filename))
+            with open(filename) as f:
+                trace = audiotest.json.load(f)
+            self.assertEqual(self.tracer.events, trace['traceEvents'])
+        finally:
+            os.unlink(filename)
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.timer = audiotest.PhaseTimer(clock=self.clock)
+
+    def test_marks(self):
+        self.clock.now = 0.5
+        self.timer.mark("playing")
+        self.clock.now = 2.0
+        self.timer.mark("sampling complete")
+        #Only the first time counts
+        self.clock.now = 3.0
+        self.timer.mark("playing")
+        self.assertEqual([{'name': "playing", 'seconds': 0.5},
+                          {'name': "sampling complete", 'seconds': 2.0}],
+                         self.timer.as_dict()['marks'])
+        self.assertIn("(+1.500 s)", self.timer.report())
+
+    def test_between(self):
+        self.clock.now = 1.5
+        self.timer.mark("recorder playing")
+        self.clock.now = 2.25
+        self.timer.mark("level in range")
+        self.assertEqual(0.75, self.timer.between("recorder playing",
+                                                  "level in range"))
+        self.assertIsNone(self.timer.between("recorder playing", "verdict"))
+
+    def test_iterations(self):
+        self.clock.now = 0.5
+        self.timer.mark("devices set up")
+        for playing in (1.0, 3.0):
+            self.timer.next_iteration()
+            self.clock.now = playing
+            self.timer.mark("recorder playing")
+            self.clock.now += 0.25 * playing
+            self.timer.mark("level in range")
+        timings = self.timer.as_dict()
+        #The overall marks are still the first ones
+        self.assertEqual([0.5, 1.0, 1.25],
+                         [mark['seconds'] for mark in timings['marks']])
+        self.assertEqual([[1.0, 1.25], [3.0, 3.75]],
+                         [[mark['seconds'] for mark in marks]
+                          for marks in timings['iterations']])
+        #From the last iteration
+        self.assertEqual(0.75, self.timer.between("recorder playing",
+                                                  "level in range"))
+        self.assertIn("Iteration 2:", self.timer.report())
+
+    def test_phases(self):
+        for duration in (0.25, 0.5):
+            self.timer.start("input commands")
+            self.clock.now += duration
+            self.timer.stop("input commands")
+        #Stopping a phase that wasn't started does nothing
+        self.timer.stop("output commands")
+        self.assertEqual([{'name': "input commands", 'seconds': 0.75,
+                           'count': 2}],
+                         self.timer.as_dict()['phases'])
+
+    def test_volume_controller_phases(self):
+        pactl_output = "0\talsa_output.pci\tmodule-alsa-card.c\t" + \
+                       "s16le 2ch 44100Hz\tSUSPENDED"
+        vc = audiotest.PAVolumeController('output',
+                                          method=lambda x: pactl_output,
+                                          timer=self.timer)
+        vc.get_identifier()
+        vc.set_volume(50)
+        phases = dict((phase['name'], phase['count'])
+                      for phase in self.timer.as_dict()['phases'])
+        #Discovery runs pactl too
+        self.assertEqual({"output device discovery": 1,
+                          "output commands": 2}, phases)
+
+    def test_level_in_range_mark(self):
+        gmh = audiotest.GStreamerMessageHandler(
+            rec_level_range=(-2.0, -12.0), logger=None,
+            volumecontroller=None, pidcontroller=None,
+            spectrum_analyzer=None, timer=self.timer)
+        pid = audiotest.PIDController(setpoint=-2.0, **audiotest.PID_GAINS)
+        vc = audiotest.SimulatedVolumeController(volume=10)
+        for level in (-40.0, -20.0, -8.0, -1.0, -5.0):
+            self.clock.now += 0.1
+            gmh.level_method(level, pid, vc)
+        #When the level first got in range, not when it was sampled
+        self.assertEqual([{'name': "level in range", 'seconds': 0.3}],
+                         [dict(mark, seconds=round(mark['seconds'], 6))
+                          for mark in self.timer.as_dict()['marks']])
+
+    def test_save(self):
+        self.timer.mark("verdict")
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertTrue(self.timer.save(filename))
+            with open(filename) as f:
+                self.assertEqual(self.timer.as_dict(),
+                                 audiotest.json.load(f))
+        finally:
+            os.unlink(filename)
+        self.assertFalse(self.timer.save("/nonexistent/timings.json"))
+
+
 class TestSpectrumAnalyzer(unittest.TestCase):
     def setUp(self):
         self.test_spectrums=[[1, 2, 3, 4, 5], 
@@ -257,23 +984,575 @@ class TestSpectrumAnalyzer(unittest.TestCase):
         highest_bands = sa.frequencies_with_peak_magnitude(threshold=2.5)
         self.assertEqual([1,84], highest_bands)
 
+    def test_reset(self):
+        sa = audiotest.SpectrumAnalyzer(points=5)
+        for i in self.test_spectrums:
+            sa.sample(i)
+        sa.reset()
+        self.assertEqual(0, sa.number_of_samples)
+        sa.sample(self.test_spectrums[0])
+        self.assertEqual(self.test_spectrums[0], sa.spectrum)
+        self.assertEqual(self.test_spectrums[0], sa.maximum)
+        self.assertEqual([0.0] * 5, sa.variance())
+
+    def test_band_statistics(self):
+        sa = audiotest.SpectrumAnalyzer(points=5)
+        for i in self.test_spectrums:
+            sa.sample(i)
+        for band in range(5):
+            values = [spectrum[band] for spectrum in self.test_spectrums]
+            self.assertAlmostEqual(statistics.variance(values),
+                                   sa.variance()[band])
+            self.assertAlmostEqual(statistics.stdev(values),
+                                   sa.standard_deviation()[band])
+            self.assertEqual(min(values), sa.minimum[band])
+            self.assertEqual(max(values), sa.maximum[band])
+
+    def test_variance_is_stable(self):
+        #A large offset ruins the naive sum of squares approach
+        sa = audiotest.SpectrumAnalyzer(points=1)
+        for value in (1e9 + 4, 1e9 + 7, 1e9 + 13, 1e9 + 16):
+            sa.sample([value])
+        self.assertAlmostEqual(30.0, sa.variance()[0])
+
+
+@unittest.skipUnless(audiotest.numpy, "numpy is not available")
+class TestNumpySpectrumAnalyzer(unittest.TestCase):
+    def setUp(self):
+        #Same fixtures as the list-based analyzer
+        TestSpectrumAnalyzer.setUp(self)
+
+    def test_average_spectrum(self):
+        sa = audiotest.NumpySpectrumAnalyzer(points=5)
+        reference = audiotest.SpectrumAnalyzer(points=5)
+        for i in self.test_spectrums:
+            sa.sample(i)
+            reference.sample(i)
+        self.assertEqual(reference.spectrum, list(sa.spectrum))
+
+    def test_different_sample_size(self):
+        sa = audiotest.NumpySpectrumAnalyzer(points=5)
+        for i in self.test_spectrums:
+            sa.sample(i)
+        spectrum = list(sa.spectrum)
+        sa.sample(self.test_spectrums[0][1:])
+        self.assertEqual(spectrum, list(sa.spectrum))
+        self.assertEqual(3, sa.number_of_samples)
+
+    def test_peak_detection(self):
+        sa = audiotest.NumpySpectrumAnalyzer(points=12)
+        sa.sample([0,2,3,2,0,0,0,4,10,9,5,0])
+        self.assertEqual([2,8], sa.frequencies_with_peak_magnitude(threshold=2.0))
+        self.assertEqual([8], sa.frequencies_with_peak_magnitude(threshold=3.1))
+
+    def test_peak_detection_real_signal(self):
+        sa = audiotest.NumpySpectrumAnalyzer(points=256)
+        sa.sample(self.real_data)
+        reference = audiotest.SpectrumAnalyzer(points=256)
+        reference.sample(self.real_data)
+        for threshold in (1.0, 1.6, 2.5):
+            self.assertEqual(
+                reference.frequencies_with_peak_magnitude(threshold=threshold),
+                sa.frequencies_with_peak_magnitude(threshold=threshold))
+
+    def test_peak_detection_base_level_tie(self):
+        #Two magnitudes appear twice, the first one seen is the base level
+        spectrum = [5, 1, 5, 3, 1, 9, 0]
+        sa = audiotest.NumpySpectrumAnalyzer(points=7)
+        sa.sample(spectrum)
+        reference = audiotest.SpectrumAnalyzer(points=7)
+        reference.sample(spectrum)
+        self.assertEqual(reference.frequencies_with_peak_magnitude(1.0),
+                         sa.frequencies_with_peak_magnitude(1.0))
+
+    def test_base_level(self):
+        spectrum = [5, 1, 5, 3, 1, 9, 0]
+        sa = audiotest.NumpySpectrumAnalyzer(points=7)
+        sa.sample(spectrum)
+        reference = audiotest.SpectrumAnalyzer(points=7)
+        reference.sample(spectrum)
+        self.assertEqual(reference.base_level(), sa.base_level())
+
+    def test_bands(self):
+        sa = audiotest.NumpySpectrumAnalyzer(points=10, sampling_frequency=3000)
+        self.assertEqual((0, 150), sa.frequencies_for_band(0))
+        self.assertEqual(3, sa.frequency_band_for(451))
+
+    def test_reset(self):
+        sa = audiotest.NumpySpectrumAnalyzer(points=5)
+        for i in self.test_spectrums:
+            sa.sample(i)
+        sa.reset()
+        self.assertEqual(0, sa.number_of_samples)
+        sa.sample(self.test_spectrums[0])
+        self.assertEqual(self.test_spectrums[0], list(sa.spectrum))
+        self.assertEqual(self.test_spectrums[0], list(sa.minimum))
+        self.assertEqual([0.0] * 5, list(sa.variance()))
+
+    def test_band_statistics(self):
+        sa = audiotest.NumpySpectrumAnalyzer(points=256)
+        reference = audiotest.SpectrumAnalyzer(points=256)
+        generator = random.Random(3)
+        for i in range(20):
+            spectrum = [generator.uniform(-60, 0) for band in range(256)]
+            sa.sample(spectrum)
+            reference.sample(spectrum)
+        for mine, theirs in ((sa.variance(), reference.variance()),
+                             (sa.minimum, reference.minimum),
+                             (sa.maximum, reference.maximum)):
+            for a, b in zip(mine, theirs):
+                self.assertAlmostEqual(a, b)
+
+
+class FakeStructure(object):
+    """Stands in for a spectrum Gst.Structure."""
+    def __init__(self, text, magnitudes=None, broken=False):
+        self.text = text
+        self.magnitudes = magnitudes
+        self.broken = broken
+
+    def get_value(self, field):
+        if self.broken:
+            raise TypeError("unknown type GstValueList")
+        return self.magnitudes
+
+    def get_list(self, field):
+        if self.broken:
+            raise TypeError("unknown type GstValueList")
+        return (False, None)
+
+    def to_string(self):
+        return self.text
+
+
+class TestGoertzel(unittest.TestCase):
+    def sine(self, frequency, length=4410, rate=44100, amplitude=0.5):
+        return [amplitude * math.sin(2 * math.pi * frequency * n / rate)
+                for n in range(length)]
+
+    def test_power_matches_spectrum_scale(self):
+        #A sine of amplitude A has a power of (A / 2) ** 2
+        power = audiotest.goertzel_power(self.sine(1000), 1000, 44100)
+        self.assertAlmostEqual(0.0625, power, places=4)
+        self.assertLess(audiotest.goertzel_power(self.sine(1000), 3000,
+                                                 44100), 1e-6)
+
+    def test_pure_python_matches_numpy(self):
+        samples = self.sine(1234)
+        numpy_module = audiotest.numpy
+        try:
+            audiotest.numpy = None
+            pure = audiotest.goertzel_power(samples, 1200, 44100)
+        finally:
+            audiotest.numpy = numpy_module
+        self.assertAlmostEqual(pure, audiotest.goertzel_power(samples, 1200,
+                                                              44100))
+
+    def test_detect_tone(self):
+        detector = audiotest.GoertzelDetector(1000, wanted_samples=3)
+        self.assertEqual([500, 700, 1400, 1800],
+                         detector.reference_frequencies)
+        for i in range(3):
+            self.assertFalse(detector.sampling_complete())
+            detector.sample(self.sine(1000))
+        self.assertTrue(detector.sampling_complete())
+        self.assertTrue(detector.tone_present(audiotest.MAGNITUDE_THRESHOLD))
+
+    def test_missing_tone(self):
+        detector = audiotest.GoertzelDetector(1000)
+        detector.sample(self.sine(3000))
+        self.assertFalse(detector.tone_present(audiotest.MAGNITUDE_THRESHOLD))
+        self.assertEqual(-60, detector.magnitudes[1000])
+
+    def test_off_band_tone(self):
+        #Two bands above the test frequency
+        for samples, present in ((self.sine(7450), False),
+                                 (self.sine(7278), True)):
+            detector = audiotest.GoertzelDetector(7278)
+            detector.sample(samples)
+            self.assertEqual(present, detector.tone_present(
+                audiotest.MAGNITUDE_THRESHOLD))
+
+    def test_neighbours(self):
+        detector = audiotest.GoertzelDetector(1000, bins=100)
+        self.assertEqual([779.5, 1220.5, 559.0, 1441.0],
+                         detector.neighbour_frequencies[1000])
+        detector = audiotest.GoertzelDetector(100, bins=100)
+        self.assertEqual([320.5, 541.0],
+                         detector.neighbour_frequencies[100])
+
+    def test_references_below_nyquist(self):
+        detector = audiotest.GoertzelDetector(15000)
+        self.assertEqual([7500, 10500, 21000],
+                         detector.reference_frequencies)
+
+    def test_references_avoid_other_tones(self):
+        detector = audiotest.GoertzelDetector([1000, 2000])
+        self.assertEqual([1000, 2000], detector.frequencies)
+        self.assertNotIn(2000 * 0.5, detector.reference_frequencies)
+        self.assertNotIn(1000 * 1.8, detector.reference_frequencies)
+        self.assertIn(1000 * 1.4, detector.reference_frequencies)
+
+    def test_blocks(self):
+        detector = audiotest.GoertzelDetector(1000, block_size=441)
+        detector.sample(self.sine(1000, length=400))
+        self.assertEqual(0, detector.number_of_samples)
+        detector.sample(self.sine(1000, length=1000))
+        self.assertEqual(3, detector.number_of_samples)
+
+    def test_reset(self):
+        detector = audiotest.GoertzelDetector(1000, block_size=441)
+        detector.sample(self.sine(1000, length=1000))
+        detector.reset()
+        self.assertEqual(0, detector.number_of_samples)
+        self.assertEqual(0.0, detector.magnitudes[1000])
+        detector.sample(self.sine(3000, length=441))
+        self.assertEqual(1, detector.number_of_samples)
+        self.assertFalse(detector.tone_present(audiotest.MAGNITUDE_THRESHOLD))
+
+    def test_pcm_samples(self):
+        data = struct.pack("<3h", 0, 32767, -32767)
+        self.assertEqual([0.0, 1.0, -1.0], list(audiotest.pcm_samples(data)))
+
 
-#I really don't know how to test this :/
 class TestGStreamerMessageHandler(unittest.TestCase):
     def setUp(self):
-     gmh = audiotest.GStreamerMessageHandler(rec_level_range=None,
+        self.gmh = audiotest.GStreamerMessageHandler(rec_level_range=None,
                                   logger=None,
                                   volumecontroller=None,
                                   pidcontroller=None,
                                   spectrum_analyzer=None)
-       
-    def test_handler(self):
-        pass
+        self.message = TestStructParsing.message
+
+    def test_direct_magnitudes(self):
+        structure = FakeStructure("garbage", magnitudes=[-60, -45.5])
+        self.assertEqual([-60.0, -45.5],
+                         self.gmh._spectrum_magnitudes(structure))
+        self.assertTrue(self.gmh._direct_magnitudes)
+
+    def test_broken_binding_falls_back_to_parsing(self):
+        structure = FakeStructure(self.message, broken=True)
+        magnitudes = self.gmh._spectrum_magnitudes(structure)
+        self.assertEqual(256, len(magnitudes))
+        self.assertEqual(-45.372245788574219, magnitudes[0])
+        self.assertFalse(self.gmh._direct_magnitudes)
+        #Once broken, don't try again
+        structure = FakeStructure(self.message, magnitudes=[1.0])
+        self.assertEqual(256, len(self.gmh._spectrum_magnitudes(structure)))
+
+    def test_missing_magnitudes(self):
+        structure = FakeStructure("spectrum, maignitude=(float){ -60 };")
+        self.assertIsNone(self.gmh._spectrum_magnitudes(structure))
+
+    def test_discard(self):
+        analyzer = audiotest.SpectrumAnalyzer(points=3)
+        self.gmh.rec_level_range = (-2.0, -12.0)
+        self.gmh.current_level = -5.0
+        self.gmh.logger = audiotest.logging
+        self.gmh.discard(0.2)
+        for i in range(3):
+            self.gmh.spectrum_method(analyzer, [float(i)] * 3)
+        self.assertEqual(1, analyzer.number_of_samples)
+        self.assertEqual([2.0] * 3, analyzer.spectrum)
+
+    def test_converged_loop_keeps_sampling(self):
+        analyzer = audiotest.SpectrumAnalyzer(points=3, wanted_samples=1000)
+        plant = audiotest.LevelPlant()
+        volume_controller = audiotest.SimulatedVolumeController(
+            0, plant.latency)
+        pid = audiotest.PIDController(setpoint=audiotest.REC_LEVEL_SETPOINT,
+                                      **audiotest.PID_GAINS)
+        pid.set_change_limit(audiotest.PID_CHANGE_LIMIT)
+        self.gmh.rec_level_range = audiotest.REC_LEVEL_RANGE
+        self.gmh.logger = audiotest.logging
+        self.gmh.volume_controller = volume_controller
+        for message in range(100):
+            if message == 50:
+                converged = analyzer.number_of_samples
+            volume_controller.advance()
+            self.gmh.level_method(plant.measure(
+                volume_controller.applied_volume), pid, volume_controller)
+            self.gmh.spectrum_method(analyzer, [0.0] * 3)
+        self.assertEqual(50, analyzer.number_of_samples - converged)
+
+    def test_discard_buffers(self):
+        #Raw buffers are much shorter than a spectrum interval
+        detector = audiotest.GoertzelDetector(2000, block_size=4410)
+        self.gmh.rec_level_range = (-2.0, -12.0)
+        self.gmh.current_level = -5.0
+        self.gmh.logger = audiotest.logging
+        self.gmh.discard(audiotest.SEQUENCE_SETTLE_TIME)
+        buffer = [0.0] * 441
+        for i in range(30):
+            self.gmh.spectrum_method(detector, buffer, 0.01)
+        self.assertEqual(0, self.gmh._discard)
+        self.assertEqual(0, detector.number_of_samples)
+        for i in range(10):
+            self.gmh.spectrum_method(detector, buffer, 0.01)
+        self.assertEqual(1, detector.number_of_samples)
+
+    def test_buffers_analyzed_in_main_loop(self):
+        class FakeLoop(object):
+            def __init__(self):
+                self.idle = []
+
+            def idle_add(self, function, *args):
+                self.idle.append((function, args))
+
+        class FakeBuffer(object):
+            def get_buffer(self):
+                return self
+
+            def get_size(self):
+                return 2 * 441
+
+            def extract_dup(self, offset, size):
+                return b"\0" * size
+
+        class FakeSink(object):
+            def emit(self, signal):
+                return FakeBuffer()
+
+        loop = FakeLoop()
+        gst = type("Gst", (), {"FlowReturn": type("F", (), {"OK": 0})})
+        saved = audiotest.GObject, audiotest.Gst
+        audiotest.GObject, audiotest.Gst = loop, gst
+        try:
+            self.gmh.spectrum_analyzer = \
+                audiotest.GoertzelDetector(2000, block_size=441)
+            self.gmh.rec_level_range = (-2.0, -12.0)
+            self.gmh.current_level = -5.0
+            self.gmh.logger = audiotest.logging
+            for i in range(3):
+                self.gmh.buffer_handler(FakeSink())
+        finally:
+            audiotest.GObject, audiotest.Gst = saved
+        #Nothing analyzed in the streaming thread
+        self.assertEqual(0, self.gmh.spectrum_analyzer.number_of_samples)
+        function, args = loop.idle.pop(0)
+        self.assertFalse(function(*args))
+        self.assertEqual(1, self.gmh.spectrum_analyzer.number_of_samples)
+        #Buffers queued before a new step or iteration are dropped
+        self.gmh.drop_queued()
+        for function, args in loop.idle:
+            function(*args)
+        self.assertEqual(1, self.gmh.spectrum_analyzer.number_of_samples)
+
+    def test_reset(self):
+        self.gmh.current_level = -5.0
+        self.gmh.settled_volume = 40
+        self.gmh.discard(0.2)
+        generation = self.gmh._generation
+        self.gmh.reset()
+        self.assertEqual(audiotest.sys.maxsize, self.gmh.current_level)
+        self.assertIsNone(self.gmh.settled_volume)
+        self.assertEqual(0, self.gmh._discard)
+        self.assertNotEqual(generation, self.gmh._generation)
+
+    def test_settled_volume_only_in_range(self):
+        analyzer = audiotest.SpectrumAnalyzer(points=3)
+        self.gmh.rec_level_range = (-2.0, -12.0)
+        self.gmh.logger = audiotest.logging
+        self.gmh.volume_controller = \
+            audiotest.SimulatedVolumeController(volume=40)
+        for level in (-30.0, 0.0):
+            self.gmh.current_level = level
+            self.gmh.spectrum_method(analyzer, [0.0] * 3)
+        self.assertIsNone(self.gmh.settled_volume)
+        self.assertEqual(0, analyzer.number_of_samples)
+        self.gmh.current_level = -5.0
+        self.gmh.spectrum_method(analyzer, [0.0] * 3)
+        self.assertEqual(40, self.gmh.settled_volume)
+
+
+class TestSequentialDecision(unittest.TestCase):
+    def spectrum(self, generator, band=None, level=-30.0, points=64):
+        spectrum = [round(generator.uniform(-60, -57), 1)
+                    for i in range(points)]
+        spectrum[:points // 2] = [-60.0] * (points // 2)
+        if band is not None:
+            spectrum[band] = level + generator.uniform(-3, 3)
+        return spectrum
 
-class TestStructParsing(unittest.TestCase):
     def setUp(self):
-        self.message = "spectrum, endtime=(guint64)4700000000, timestamp=(guint64)4600000000, stream-time=(guint64)4600000000, running-time=(guint64)4600000000, duration=(guint64)100000000, magnitude=(float){ -45.372245788574219, -49.466854095458984, -57.898105621337891, -59.449321746826172, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60 };"
-        self.bad_message = "spectrum, endtime=(guint64)4700000000, timestamp=(guint64)4600000000, stream-time=(guint64)4600000000, running-time=(guint64)4600000000, duration=(guint64)100000000, maignitude=(float){ -45.372245788574219, -49.466854095458984, -57.898105621337891, -59.449321746826172, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60 };"
+        self.generator = random.Random(7)
+        self.analyzer = audiotest.SpectrumAnalyzer(points=64,
+                                                   sampling_frequency=6400)
+        #Band 40
+        self.decision = audiotest.SequentialDecision(self.analyzer, [2025])
+
+    def test_clear_tone_passes_early(self):
+        for i in range(4):
+            self.assertIsNone(self.decision.verdict())
+            self.decision.sample(self.spectrum(self.generator, 40))
+        self.assertEqual(0, self.decision.verdict())
+
+    def test_missing_tone_fails_early(self):
+        for i in range(10):
+            self.decision.sample(self.spectrum(self.generator))
+        self.assertEqual(1, self.decision.verdict())
+
+    def test_borderline_tone_undecided(self):
+        #Sometimes above the neighbours, sometimes not
+        for level in (-55.0, -59.0, -54.0, -60.0, -56.0):
+            self.decision.sample(self.spectrum(self.generator, 40, level))
+        self.assertIsNone(self.decision.verdict())
+
+    def test_any_missing_tone_fails(self):
+        decision = audiotest.SequentialDecision(self.analyzer, [2025, 2525])
+        for i in range(20):
+            decision.sample(self.spectrum(self.generator, 40))
+        self.assertEqual(1, decision.verdict())
+
+    def test_t_quantile(self):
+        #From the usual tables
+        for tail, df, t in ((0.025, 1, 12.706), (0.025, 2, 4.303),
+                            (0.005, 3, 5.841), (0.05, 5, 2.015),
+                            (0.025, 10, 2.228)):
+            self.assertAlmostEqual(t, audiotest.t_quantile(tail, df), 3)
+
+    def error_rate(self, margin, error_rate, runs=1000):
+        """Fraction of runs with a tone margin dB over the threshold, give
+           or take 3 dB, that stop early with each verdict.
+        """
+        generator = random.Random(3)
+        spectrum = [-60.0] * 64
+        base = -60.0 + audiotest.MAGNITUDE_THRESHOLD
+        verdicts = []
+        for run in range(runs):
+            decision = audiotest.SequentialDecision(self.analyzer, [2025],
+                                                    error_rate=error_rate)
+            for i in range(self.analyzer.wanted_samples):
+                spectrum[40] = base + generator.gauss(margin, 3.0)
+                decision.sample(spectrum)
+                if decision.verdict() is not None:
+                    break
+            verdicts.append(decision.verdict())
+        return (verdicts.count(0) / float(runs),
+                verdicts.count(1) / float(runs))
+
+    def test_error_rate(self):
+        #Either verdict is wrong with no margin at all
+        passed, failed = self.error_rate(0.0, 0.05)
+        self.assertLess(passed, 0.05)
+        self.assertLess(failed, 0.05)
+        #A tone 1 dB over the threshold is there
+        passed, failed = self.error_rate(1.0, 0.05)
+        self.assertLess(failed, 0.05)
+
+    def test_reset(self):
+        for i in range(3):
+            self.decision.sample(self.spectrum(self.generator, 40))
+        self.decision.reset()
+        self.assertIsNone(self.decision.verdict())
+
+    def test_handler_stops_early(self):
+        quit = []
+        gmh = audiotest.GStreamerMessageHandler(
+            rec_level_range=(-2.0, -12.0), logger=audiotest.logging,
+            volumecontroller=None, pidcontroller=None,
+            spectrum_analyzer=self.analyzer, decision=self.decision)
+        gmh.set_quit_method(lambda: quit.append(True))
+        gmh.current_level = -5.0
+        while not quit:
+            gmh.spectrum_method(self.analyzer,
+                                self.spectrum(self.generator, 40))
+        self.assertEqual(4, self.analyzer.number_of_samples)
+        self.assertFalse(self.analyzer.sampling_complete())
+        self.assertEqual(0, audiotest.judge_spectrum(self.analyzer, [2025]))
+
+    def test_early_fail_reported(self):
+        #The decision's margins and the averaged spectrum can disagree,
+        #the verdict sampling stopped on wins
+        for i in range(self.analyzer.wanted_samples):
+            self.analyzer.sample(self.spectrum(self.generator, 40))
+            self.decision.sample(self.spectrum(self.generator))
+            if self.decision.verdict() is not None:
+                break
+        self.assertEqual(1, self.decision.verdict())
+        self.assertEqual(0, audiotest.judge_spectrum(self.analyzer, [2025]))
+        self.assertEqual(1, audiotest.judge_spectrum(self.analyzer, [2025],
+                                                     decision=self.decision))
+
+    def test_undecided_falls_back_to_spectrum(self):
+        self.analyzer.sample(self.spectrum(self.generator, 40))
+        self.decision.sample(self.spectrum(self.generator))
+        self.assertIsNone(self.decision.verdict())
+        self.assertEqual(0, audiotest.judge_spectrum(self.analyzer, [2025],
+                                                     decision=self.decision))
+
+    def test_band_verdicts(self):
+        decision = audiotest.SequentialDecision(self.analyzer, [2025, 2525])
+        for i in range(20):
+            decision.sample(self.spectrum(self.generator, 40))
+        self.assertEqual([0, 1], decision.band_verdicts())
+        self.assertGreater(decision.margins()[0], 0)
+
+
+class FakePlayer(object):
+    def __init__(self):
+        self.frequencies = []
+
+    def set_frequency(self, frequency):
+        self.frequencies.append(frequency)
+
+
+class TestSequenceRunner(unittest.TestCase):
+    def setUp(self):
+        self.gmh = audiotest.GStreamerMessageHandler(rec_level_range=None,
+                                  logger=None,
+                                  volumecontroller=None,
+                                  pidcontroller=None,
+                                  spectrum_analyzer=None)
+        self.player = FakePlayer()
+        self.prepared = []
+        self.judged = []
+        self.quit = []
+        self.runner = audiotest.SequenceRunner(
+            [500, 2000, 6000], self.player, self.gmh,
+            prepare=self.prepared.append,
+            judge=lambda analyzer, f: self.judged.append(f) or f == 2000,
+            step_duration=10, quit_method=lambda: self.quit.append(True))
+        #No main loop to run the timeouts in
+        self.runner._start_timeout = lambda: None
+
+    def test_steps(self):
+        self.runner.start()
+        self.runner.step_complete()
+        self.assertEqual([2000], self.player.frequencies)
+        self.assertEqual([500, 2000], self.prepared)
+        self.assertEqual(audiotest.SEQUENCE_SETTLE_TIME, self.gmh._discard)
+        self.runner.step_complete()
+        self.runner.step_complete()
+        self.assertEqual([500, 2000, 6000], self.judged)
+        self.assertEqual([True], self.quit)
+        self.assertEqual(1, self.runner.result())
+        #Late messages after the last step are ignored
+        self.runner.step_complete()
+        self.assertEqual([True], self.quit)
+
+    def test_stale_timeout(self):
+        self.runner.start()
+        self.runner.step_complete()
+        #The timeout for the first step fires after it was completed
+        self.assertFalse(self.runner._timeout(0))
+        self.assertEqual([500], self.judged)
+        self.runner._timeout(1)
+        self.assertEqual([500, 2000], self.judged)
+
+    def test_result(self):
+        self.runner.start()
+        self.runner.step_complete()
+        self.assertEqual(1, self.runner.result())
+        self.runner.judge = lambda analyzer, f: 0
+        self.runner.step_complete()
+        self.runner.step_complete()
+        self.assertEqual(0, self.runner.result())
+
+
+class TestStructParsing(unittest.TestCase):
+    message = "spectrum, endtime=(guint64)4700000000, timestamp=(guint64)4600000000, stream-time=(guint64)4600000000, running-time=(guint64)4600000000, duration=(guint64)100000000, magnitude=(float){ -45.372245788574219, -49.466854095458984, -57.898105621337891, -59.449321746826172, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60 };"
+    bad_message = "spectrum, endtime=(guint64)4700000000, timestamp=(guint64)4600000000, stream-time=(guint64)4600000000, running-time=(guint64)4600000000, duration=(guint64)100000000, maignitude=(float){ -45.372245788574219, -49.466854095458984, -57.898105621337891, -59.449321746826172, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60, -60 };"
 
     def test_spectrum_message_parsing(self):
         struct = audiotest.parse_spectrum_message_structure(self.message)
@@ -289,5 +1568,367 @@ class TestStructParsing(unittest.TestCase):
         self.assertEqual(len(struct['magnitude']), 256)
 
 
+class TestStructScanning(unittest.TestCase):
+    def setUp(self):
+        self.message = TestStructParsing.message
+        self.bad_message = TestStructParsing.bad_message
+
+    def test_spectrum_message_scanning(self):
+        struct = audiotest.scan_spectrum_message_structure(self.message)
+        self.assertIn('magnitude', struct)
+
+    def test_spectrum_bad_message_scanning(self):
+        struct = audiotest.scan_spectrum_message_structure(self.bad_message)
+        self.assertNotIn('magnitude', struct)
+
+    def test_spectrum_message_has_expected_size(self):
+        struct = audiotest.scan_spectrum_message_structure(self.message)
+        self.assertEqual(len(struct['magnitude']), 256)
+
+    def test_same_result_as_parser(self):
+        struct = audiotest.scan_spectrum_message_structure(self.message)
+        parsed = audiotest.parse_spectrum_message_structure(self.message)
+        self.assertEqual(parsed, dict(struct))
+
+    def test_array_typecode(self):
+        struct = audiotest.scan_spectrum_message_structure(self.message,
+                                                           typecode='f')
+        self.assertEqual('f', struct['magnitude'].typecode)
+        self.assertAlmostEqual(-45.372245788574219, struct['magnitude'][0],
+                               places=5)
+
+    def test_scalar_fields(self):
+        struct = audiotest.scan_spectrum_message_structure(
+            "spectrum, endtime=(guint64)4700000000, "
+            "magnitude=(float){ -60, -1.5 }, flag=(boolean)true;")
+        self.assertEqual(4700000000, struct['endtime'])
+        self.assertEqual([-60.0, -1.5], struct['magnitude'])
+        self.assertTrue(struct['flag'])
+
+    def test_malformed_message(self):
+        self.assertIsNone(audiotest.scan_spectrum_message_structure(
+            "spectrum, magnitude=(float){ -60, -60"))
+
+
+class TestWavReader(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def write_counting_wav(self, frames, channels=1):
+        writer = wave.open(self.filename, 'wb')
+        writer.setnchannels(channels)
+        writer.setsampwidth(2)
+        writer.setframerate(8000)
+        writer.writeframes(struct.pack("<%dh" % (frames * channels),
+                                       *range(frames * channels)))
+        writer.close()
+
+    def test_header(self):
+        self.write_counting_wav(100, channels=2)
+        with audiotest.WavReader(self.filename) as reader:
+            self.assertEqual(2, reader.channels)
+            self.assertEqual(8000, reader.sampling_frequency)
+            self.assertEqual(100, len(reader))
+            self.assertEqual(list(range(200)), list(reader.samples))
+
+    def test_overlapping_frames(self):
+        self.write_counting_wav(10)
+        with audiotest.WavReader(self.filename) as reader:
+            frames = [[int(s) for s in frame.reshape(-1)]
+                      if audiotest.numpy is not None else list(frame)
+                      for frame in reader.frames(4, hop=3)]
+        self.assertEqual([[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 9]], frames)
+
+    @unittest.skipUnless(audiotest.numpy, "numpy is not available")
+    def test_frames_are_views(self):
+        self.write_counting_wav(10, channels=2)
+        with audiotest.WavReader(self.filename) as reader:
+            frame = next(reader.frames(5))
+            self.assertEqual((5, 2), frame.shape)
+            self.assertFalse(frame.flags.owndata)
+            del frame
+
+    def test_unfinished_header(self):
+        #As left behind by an interrupted recording
+        self.write_counting_wav(10)
+        with open(self.filename, "r+b") as f:
+            f.seek(40)
+            f.write(struct.pack("<I", 0))
+        with audiotest.WavReader(self.filename) as reader:
+            self.assertEqual(10, len(reader))
+
+    def test_invalid_files(self):
+        for content in (b"", b"RIFF", b"RIFF\0\0\0\0WAVEdata"):
+            with open(self.filename, "wb") as f:
+                f.write(content)
+            self.assertRaises(wave.Error, audiotest.WavReader, self.filename)
+
+
+@unittest.skipUnless(audiotest.numpy, "numpy is not available")
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        numpy = audiotest.numpy
+        self.numpy = numpy
+        self.sweep = audiotest.exponential_sweep(duration=1)
+        #Recording starts a bit before the sweep and ends a bit after it
+        self.recorded = numpy.concatenate((numpy.zeros(2000), self.sweep,
+                                           numpy.zeros(4000)))
+
+    def band(self, frequencies, magnitudes, low, high):
+        return magnitudes[(frequencies >= low) & (frequencies <= high)]
+
+    def test_sweep(self):
+        self.assertEqual(44100, len(self.sweep))
+        self.assertLessEqual(self.numpy.abs(self.sweep).max(), 0.5)
+
+    def test_flat_response(self):
+        #Half the amplitude is -6 dB at every frequency
+        frequencies, magnitudes = audiotest.sweep_response(
+            self.recorded * 0.5, self.sweep, bins=64)
+        self.assertEqual(64, len(frequencies))
+        in_band = self.band(frequencies, magnitudes, 200, 15000)
+        self.assertTrue((abs(in_band + 6.02) < 0.5).all(), in_band)
+
+    def test_lowpass_response(self):
+        #Averaging consecutive samples attenuates high frequencies
+        filtered = self.numpy.convolve(self.recorded, [0.5, 0.5])
+        frequencies, magnitudes = audiotest.sweep_response(
+            filtered, self.sweep, bins=64)
+        low = self.band(frequencies, magnitudes, 200, 1000)
+        high = self.band(frequencies, magnitudes, 14000, 16000)
+        self.assertTrue((abs(low) < 0.5).all(), low)
+        self.assertTrue((high < -5).all(), high)
+
+    def test_capture(self):
+        capture = audiotest.SweepCapture(5)
+        capture.add(self.numpy.ones(3))
+        self.assertFalse(capture.complete())
+        capture.add(self.numpy.ones(3))
+        self.assertTrue(capture.complete())
+        self.assertEqual(5, len(capture.samples()))
+
+
+class TestArguments(unittest.TestCase):
+    def test_frequency_list(self):
+        self.assertEqual([500], audiotest.frequency_list("500"))
+        self.assertEqual([500, 2000, 6000],
+                         audiotest.frequency_list("500,2000,6000"))
+        self.assertRaises(audiotest.argparse.ArgumentTypeError,
+                          audiotest.frequency_list, "500,high")
+
+
+    def test_percentile(self):
+        durations = [2.0, 1.0, 4.0, 3.0]
+        self.assertEqual(2.0, audiotest.percentile(durations, 0.5))
+        self.assertEqual(4.0, audiotest.percentile(durations, 0.95))
+        self.assertEqual(1.0, audiotest.percentile(durations, 0))
+        self.assertEqual(7.5, audiotest.percentile([7.5], 0.95))
+
+
+class TestReport(unittest.TestCase):
+    def test_spectrum_report(self):
+        sa = audiotest.SpectrumAnalyzer(points=12, sampling_frequency=2400)
+        sa.sample([0,2,3,2,0,0,0,4,10,9,5,0])
+        report = audiotest.analysis_report(sa, [850, 550])
+        self.assertEqual(1, report['samples'])
+        self.assertEqual(0, report['base_level'])
+        self.assertEqual([2, 8], report['peak_bands'])
+        self.assertEqual({'frequency': 850, 'band': 8, 'present': True,
+                          'band_range': [800.0, 900.0], 'magnitude': 10.0,
+                          'standard_deviation': 0.0},
+                         report['frequencies'][0])
+        self.assertFalse(report['frequencies'][1]['present'])
+
+    def test_goertzel_report(self):
+        detector = audiotest.GoertzelDetector(1000)
+        detector.sample([0.5 * math.sin(2 * math.pi * 1000 * n / 44100)
+                         for n in range(4410)])
+        report = audiotest.analysis_report(detector, [1000])
+        self.assertEqual(detector.base_level(), report['base_level'])
+        self.assertTrue(report['frequencies'][0]['present'])
+        self.assertNotIn('peak_bands', report)
+
+    def test_write_json(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertTrue(audiotest.write_json(filename, {'verdict': 'PASS'}))
+            with open(filename) as f:
+                self.assertEqual({'verdict': 'PASS'}, audiotest.json.load(f))
+        finally:
+            os.unlink(filename)
+        self.assertFalse(audiotest.write_json("/nonexistent/report.json", {}))
+
+
+class TestAllDevices(unittest.TestCase):
+    def test_device_frequencies(self):
+        sa = audiotest.SpectrumAnalyzer(points=audiotest.BINS)
+        frequencies = audiotest.device_frequencies(6)
+        self.assertEqual(6, len(frequencies))
+        bands = [sa.frequency_band_for(f) for f in frequencies]
+        for low, high in zip(bands, bands[1:]):
+            self.assertGreaterEqual(high - low, 3)
+        #No tone is a harmonic of another
+        self.assertLess(frequencies[-1], 2 * frequencies[0])
+
+    def test_harmonics_miss_other_tones(self):
+        for bins in (64, audiotest.BINS):
+            sa = audiotest.SpectrumAnalyzer(
+                points=bins, sampling_frequency=audiotest.SAMPLING_FREQUENCY)
+            count = 1
+            while audiotest.device_frequencies(count + 1, bins=bins):
+                count += 1
+            for n in range(2, count + 1):
+                frequencies = audiotest.device_frequencies(n, bins=bins)
+                bands = [sa.frequency_band_for(f) for f in frequencies]
+                for frequency in frequencies:
+                    for harmonic in (2, 3):
+                        band = sa.frequency_band_for(harmonic * frequency)
+                        if band is None:
+                            #Above the Nyquist frequency
+                            continue
+                        for other in bands:
+                            self.assertGreater(abs(band - other), 1,
+                                               (bins, frequencies))
+
+    def test_too_many_devices(self):
+        self.assertEqual(1, len(audiotest.device_frequencies(1)))
+        self.assertIsNone(audiotest.device_frequencies(60))
+
+    def test_judge_matrix(self):
+        sa = audiotest.SpectrumAnalyzer(points=audiotest.BINS)
+        frequencies = {'speaker': 4435, 'headphones': 5900}
+        spectrum = [-60.0] * audiotest.BINS
+        spectrum[sa.frequency_band_for(4435)] = -30.0
+        sa.sample(spectrum)
+        silent = audiotest.SpectrumAnalyzer(points=audiotest.BINS)
+        silent.sample([-60.0] * audiotest.BINS)
+        matrix = audiotest.judge_matrix({'mic': sa, 'usb': silent},
+                                        frequencies)
+        self.assertEqual({'mic': {'speaker': True, 'headphones': False},
+                          'usb': {'speaker': False, 'headphones': False}},
+                         matrix)
+
+
+def write_wav(filename, frequencies, seconds=3, rate=44100, amplitude=0.3,
+              noise=0.01, channels=1):
+    """Writes a 16 bit .wav with the sum of given sines plus some noise."""
+    generator = random.Random(42)
+    frames = []
+    for n in range(int(seconds * rate)):
+        value = sum(amplitude * math.sin(2 * math.pi * f * n / rate)
+                    for f in frequencies)
+        value += generator.uniform(-noise, noise)
+        frames.extend([int(value * 32767)] * channels)
+    writer = wave.open(filename, 'wb')
+    writer.setnchannels(channels)
+    writer.setsampwidth(2)
+    writer.setframerate(rate)
+    writer.writeframes(struct.pack("<%dh" % len(frames), *frames))
+    writer.close()
+
+
+@unittest.skipUnless(audiotest.numpy, "numpy is not available")
+class TestOfflineAnalysis(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        self.frequency = audiotest.DEFAULT_TEST_FREQUENCY
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_spectrum_frames(self):
+        chunks = [audiotest.numpy.zeros(4410)] * 10
+        frames = list(audiotest.wav_spectrum_frames(chunks, bins=256))
+        self.assertEqual(10, len(frames))
+        level, magnitudes = frames[0]
+        self.assertEqual(float('-inf'), level)
+        self.assertEqual(256, len(magnitudes))
+        self.assertTrue((magnitudes == -60).all())
+
+    def test_tone_is_detected(self):
+        write_wav(self.filename, [self.frequency])
+        analyzer = audiotest.analyze_wav_file(self.filename)
+        self.assertTrue(analyzer.sampling_complete())
+        self.assertEqual(0, audiotest.judge_spectrum(analyzer, [self.frequency]))
+        band = analyzer.frequency_band_for(self.frequency)
+        self.assertEqual(band, int(audiotest.numpy.argmax(analyzer.spectrum)))
+
+    def test_stereo_recording(self):
+        write_wav(self.filename, [self.frequency], seconds=1, channels=2)
+        analyzer = audiotest.analyze_wav_file(self.filename)
+        self.assertEqual(0, audiotest.judge_spectrum(analyzer, [self.frequency]))
+
+    def test_missing_tone(self):
+        write_wav(self.filename, [2 * self.frequency])
+        analyzer = audiotest.analyze_wav_file(self.filename)
+        self.assertEqual(1, audiotest.judge_spectrum(analyzer, [self.frequency]))
+
+    def test_configurable_bins(self):
+        #A quarter of the way into band 300
+        frequency = (44100 / 2.0 / 1024) * 300.25
+        write_wav(self.filename, [frequency], seconds=1)
+        analyzer = audiotest.analyze_wav_file(self.filename, bins=1024)
+        self.assertEqual(1024, len(analyzer.spectrum))
+        self.assertEqual(0, audiotest.judge_spectrum(analyzer, [frequency]))
+
+    def test_short_intervals(self):
+        #Fewer samples per interval than an FFT needs
+        chunks = [audiotest.numpy.ones(100) * 0.5] * 3
+        frames = list(audiotest.wav_spectrum_frames(chunks, bins=256))
+        self.assertEqual(3, len(frames))
+        self.assertAlmostEqual(20 * math.log10(0.5), frames[0][0])
+        #Energy is concentrated in DC
+        self.assertEqual(0, int(audiotest.numpy.argmax(frames[2][1])))
+
+    def test_goertzel(self):
+        write_wav(self.filename, [self.frequency], seconds=2)
+        detector = audiotest.analyze_wav_file(self.filename,
+                                              tone_frequencies=[self.frequency])
+        self.assertTrue(detector.sampling_complete())
+        self.assertEqual(0, audiotest.judge_tone(detector, [self.frequency]))
+        self.assertEqual(1, audiotest.judge_tone(
+            audiotest.analyze_wav_file(self.filename, tone_frequencies=[1000]),
+            [1000]))
+
+    def test_goertzel_off_band_tone(self):
+        #Two bands away from the test frequency, both ways fail
+        write_wav(self.filename, [self.frequency + 2 * 44100 / 2.0 / 256],
+                  seconds=2)
+        analyzer = audiotest.analyze_wav_file(self.filename)
+        self.assertEqual(1, audiotest.judge_spectrum(analyzer,
+                                                     [self.frequency]))
+        detector = audiotest.analyze_wav_file(self.filename,
+                                              tone_frequencies=[self.frequency])
+        self.assertEqual(1, audiotest.judge_tone(detector, [self.frequency]))
+
+    def test_multiple_tones(self):
+        #Quarter of the way into bands 20, 60 and 120
+        band_width = 44100 / 2.0 / 256
+        tones = [band_width * (b + 0.25) for b in (20, 60, 120)]
+        write_wav(self.filename, tones, amplitude=0.2)
+        analyzer = audiotest.analyze_wav_file(self.filename)
+        self.assertEqual(0, audiotest.judge_spectrum(analyzer, tones))
+        self.assertEqual(1, audiotest.judge_spectrum(
+            analyzer, tones + [band_width * 90.25]))
+        detector = audiotest.analyze_wav_file(self.filename,
+                                              tone_frequencies=tones)
+        self.assertEqual(0, audiotest.judge_tone(detector, tones))
+        detector = audiotest.analyze_wav_file(
+            self.filename, tone_frequencies=tones + [band_width * 90.25])
+        self.assertEqual(1, audiotest.judge_tone(
+            detector, tones + [band_width * 90.25]))
+
+    def test_unreadable_file(self):
+        with open(self.filename, "w") as f:
+            f.write("not a wav file")
+        self.assertIsNone(audiotest.analyze_wav_file(self.filename))
+
+
 if __name__ == '__main__':
     unittest.main()